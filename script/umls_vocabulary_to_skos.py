@@ -1,6 +1,7 @@
 __author__ = 'janos'
 
 import sys
+import re
 import logging
 import json
 import os
@@ -8,6 +9,29 @@ import string
 import codecs
 import csv
 import sets
+import threading
+import Queue
+import zlib
+import hashlib
+import struct
+import math
+import collections
+import cPickle
+import array
+import bisect
+
+DEFAULT_PIPELINE_QUEUE_DEPTH = 64
+DEFAULT_PREFETCH_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_WRITE_BATCH_SIZE = 256 * 1024
+DEFAULT_STORE_BATCH_SIZE = 50000
+DEFAULT_LOOKUP_CACHE_SIZE = 10000
+
+# Language tags for the LAT values of MRCONSO, other values are lower cased
+UMLS_LANGUAGE_TAGS = {"ENG": "en", "FRE": "fr", "GER": "de", "SPA": "es", "POR": "pt", "ITA": "it", "DUT": "nl",
+                      "JPN": "ja", "CZE": "cs", "SWE": "sv", "FIN": "fi", "RUS": "ru", "HUN": "hu", "NOR": "no",
+                      "DAN": "da", "POL": "pl", "KOR": "ko", "CHI": "zh", "HEB": "he", "LAV": "lv", "EST": "et",
+                      "GRE": "el", "HRV": "hr", "SCR": "hr", "TUR": "tr", "BAQ": "eu", "ARA": "ar", "ICE": "is",
+                      "LIT": "lt", "UKR": "uk", "PER": "fa", "SLO": "sk", "BUL": "bg", "RUM": "ro", "THA": "th"}
 
 
 class RRFReader(object):
@@ -30,24 +54,719 @@ class RRFReader(object):
     def next(self):
         try:
             line = self.fp.next()
-            split_line = line.rstrip().split(self.delimiter)
-            rrf_dictionary = {}
-            i = 0
+            return self._parse_line(line)
 
-            for cell_value in split_line[:-1]:
-                if len(cell_value) == 0:
-                    cell_value = None
+        except StopIteration:
+            raise StopIteration
 
-                rrf_dictionary[self.column_position[i]] = cell_value
-                i += 1
+    def _parse_line(self, line):
+        split_line = line.rstrip().split(self.delimiter)
+        rrf_dictionary = {}
+        i = 0
 
-            return rrf_dictionary
+        for cell_value in split_line[:-1]:
+            if len(cell_value) == 0:
+                cell_value = None
 
-        except StopIteration:
-            raise StopIteration
+            rrf_dictionary[self.column_position[i]] = cell_value
+            i += 1
 
+        return rrf_dictionary
 
-def read_file_layout(file_name):
+    def close(self):
+        self.fp.close()
+
+
+class PrefetchingRRFReader(RRFReader):
+    """An RRFReader which reads large blocks of lines on a separate thread so that disk reads overlap with
+    parsing the rows. The queue of blocks is bounded so the reader thread stops when the consumer falls behind."""
+    def __init__(self, file_name, column_position, delimiter="|", block_size=DEFAULT_PREFETCH_BLOCK_SIZE,
+                 queue_depth=DEFAULT_PIPELINE_QUEUE_DEPTH):
+        RRFReader.__init__(self, file_name, column_position, delimiter)
+        self.block_size = block_size
+        self.block_queue = Queue.Queue(maxsize=queue_depth)
+        self.block = iter([])
+        self.finished = False
+        self.stopped = False
+        self.read_error = None
+
+        self.reader_thread = threading.Thread(target=self._read_blocks)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def _read_blocks(self):
+        try:
+            while not self.stopped:
+                lines = self.fp.readlines(self.block_size)
+                if not lines:
+                    break
+                self.block_queue.put(lines)
+        except IOError as e:
+            self.read_error = e
+        finally:
+            self.block_queue.put(None)
+
+    def next(self):
+        while True:
+            try:
+                return self._parse_line(self.block.next())
+            except StopIteration:
+                if self.finished:
+                    raise StopIteration
+
+                lines = self.block_queue.get()
+                if lines is None:
+                    self.finished = True
+                    self.fp.close()
+                    if self.read_error is not None:
+                        logging.error("Error reading '%s'", os.path.abspath(self.file_name))
+                        raise self.read_error
+                    raise StopIteration
+                self.block = iter(lines)
+
+    def close(self):
+        """Stop the reader thread when iteration ends early. The queue is drained so a blocked put returns."""
+        self.stopped = True
+        if not self.finished:
+            self.finished = True
+            while self.block_queue.get() is not None:
+                pass
+        self.reader_thread.join()
+        self.fp.close()
+
+
+def open_rrf_reader(file_name, column_position, pipeline_queue_depth=None):
+    """Returns a prefetching reader when a pipeline queue depth is given otherwise a plain RRFReader"""
+    if pipeline_queue_depth:
+        return PrefetchingRRFReader(file_name, column_position, queue_depth=pipeline_queue_depth)
+    else:
+        return RRFReader(file_name, column_position)
+
+
+class PipelinedTripleWriter(object):
+    """Wraps a file object so that writes are batched and done on a separate writer thread. This keeps the disk
+    busy while triples are being formatted. The queue is bounded so a slow disk blocks the producer instead of
+    buffering the whole output in memory."""
+    def __init__(self, fp, queue_depth=DEFAULT_PIPELINE_QUEUE_DEPTH, batch_size=DEFAULT_WRITE_BATCH_SIZE):
+        self.fp = fp
+        self.batch_size = batch_size
+        self.batch = []
+        self.batch_length = 0
+        self.write_error = None
+
+        self.write_queue = Queue.Queue(maxsize=queue_depth)
+        self.writer_thread = threading.Thread(target=self._write_batches)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def _write_batches(self):
+        # Any error is kept for the producer and the queue is still drained so write and close never block
+        while True:
+            batch = self.write_queue.get()
+            if batch is None:
+                break
+            if self.write_error is None:
+                try:
+                    self.fp.write(batch)
+                except Exception as e:
+                    self.write_error = e
+
+    def write(self, text):
+        if self.write_error is not None:
+            raise self.write_error
+
+        self.batch.append(text)
+        self.batch_length += len(text)
+        if self.batch_length >= self.batch_size:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        if self.batch:
+            self.write_queue.put("".join(self.batch))
+            self.batch = []
+            self.batch_length = 0
+
+    def close(self):
+        self._flush_batch()
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.fp.close()
+        if self.write_error is not None:
+            raise self.write_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def split_ntriples_line(line):
+    """Split a line of N-Triples into its subject, predicate and object terms"""
+    subject_term, predicate_term, object_term = line.split(" ", 2)
+    object_term = object_term.rstrip()
+    if object_term[-1] == ".":
+        object_term = object_term[:-1].rstrip()
+    return subject_term, predicate_term, object_term
+
+
+class SQLiteTripleStore(object):
+    """An embedded quad store in SQLite. Terms are kept in N-Triples form in a dictionary table and quads are stored
+    as integer term ids. Inserts are done in bulk inside a transaction and the indexes for subject and predicate
+    lookups are built when the store is closed."""
+    def __init__(self, database_file_name, batch_size=DEFAULT_STORE_BATCH_SIZE):
+        self.database_file_name = database_file_name
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+        import sqlite3
+
+        # Graph writers may be driven from a PipelinedTripleWriter thread
+        self.connection = sqlite3.connect(database_file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("PRAGMA journal_mode = MEMORY")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS quads (g INTEGER NOT NULL, s INTEGER NOT NULL, "
+                                "p INTEGER NOT NULL, o INTEGER NOT NULL)")
+
+        self.term_ids = {}
+        for term_id, term in self.connection.execute("SELECT id, term FROM terms"):
+            self.term_ids[term] = term_id
+        self.next_term_id = max(self.term_ids.values() or [0]) + 1
+
+    def _term_id(self, term, new_terms):
+        if term in self.term_ids:
+            return self.term_ids[term]
+        else:
+            term_id = self.next_term_id
+            self.next_term_id += 1
+            self.term_ids[term] = term_id
+            new_terms.append((term_id, term))
+            return term_id
+
+    def add_ntriples_lines(self, graph, lines):
+        """Dictionary encode and insert a list of N-Triples lines into graph"""
+        with self.lock:
+            new_terms = []
+            graph_id = self._term_id(graph, new_terms)
+            quads = []
+            for line in lines:
+                subject_term, predicate_term, object_term = split_ntriples_line(line)
+                quads.append((graph_id, self._term_id(subject_term, new_terms),
+                              self._term_id(predicate_term, new_terms), self._term_id(object_term, new_terms)))
+
+            self.connection.executemany("INSERT INTO terms (id, term) VALUES (?, ?)", new_terms)
+            self.connection.executemany("INSERT INTO quads (g, s, p, o) VALUES (?, ?, ?, ?)", quads)
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    def graph_writer(self, graph):
+        """Returns a writer for graph. Quads already stored in the graph are removed so publishing again replaces
+        the graph instead of adding a second copy."""
+        with self.lock:
+            if graph in self.term_ids:
+                self.connection.execute("DELETE FROM quads WHERE g = ?", (self.term_ids[graph],))
+        return SQLiteGraphWriter(self, graph)
+
+    def create_indexes(self):
+        with self.lock:
+            self.connection.execute("CREATE INDEX IF NOT EXISTS quads_sp ON quads (s, p)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS quads_p ON quads (p)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS quads_g ON quads (g)")
+            self.connection.commit()
+
+    def triples(self, subject=None, predicate=None, graph=None):
+        """Generate (subject, predicate, object) tuples of N-Triples terms matching the given terms. The matches
+        are read under the store lock before the first one is returned, so graph writers on other threads can keep
+        loading. The subject and predicate indexes only exist after create_indexes or close, before that every
+        lookup scans the quads."""
+        with self.lock:
+            conditions = []
+            parameters = []
+            for column, term in (("q.s", subject), ("q.p", predicate), ("q.g", graph)):
+                if term is not None:
+                    if term not in self.term_ids:
+                        return
+                    conditions.append(column + " = ?")
+                    parameters.append(self.term_ids[term])
+
+            query = "SELECT ts.term, tp.term, tob.term FROM quads q JOIN terms ts ON ts.id = q.s " \
+                    "JOIN terms tp ON tp.id = q.p JOIN terms tob ON tob.id = q.o"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+
+            rows = self.connection.execute(query, parameters).fetchall()
+
+        for row in rows:
+            yield row
+
+    def close(self):
+        self.create_indexes()
+        self.connection.close()
+
+
+class SQLiteGraphWriter(object):
+    """A file like object which loads N-Triples text written to it into a named graph of a SQLiteTripleStore"""
+    def __init__(self, triple_store, graph):
+        self.triple_store = triple_store
+        self.graph = graph
+        self.lines = []
+        self.partial_line = ""
+
+    def write(self, text):
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+        self.lines.extend(line for line in lines if line.strip())
+        if len(self.lines) >= self.triple_store.batch_size:
+            self._flush_lines()
+
+    def _flush_lines(self):
+        if self.lines:
+            self.triple_store.add_ntriples_lines(self.graph, self.lines)
+            self.lines = []
+
+    def close(self):
+        if self.partial_line.strip():
+            self.lines.append(self.partial_line)
+            self.partial_line = ""
+        self._flush_lines()
+        self.triple_store.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShardedTripleWriter(object):
+    """A file like object which splits N-Triples over several shard files. With number_of_shards set triples go to a
+    shard chosen by a hash of the subject URI, otherwise a new shard is started once max_shard_triples triples or
+    max_shard_bytes bytes have been written. A JSON manifest listing the shards with their triple counts and MD5
+    checksums is written on close."""
+    def __init__(self, file_name, open_shard, number_of_shards=None, max_shard_triples=None, max_shard_bytes=None):
+        self.file_name = file_name
+        self.open_shard = open_shard
+        self.number_of_shards = number_of_shards
+        self.max_shard_triples = max_shard_triples
+        self.max_shard_bytes = max_shard_bytes
+
+        base_file_name = os.path.splitext(file_name)[0]
+        self.shard_file_name_template = base_file_name + "_shard_%04d.nt"
+        self.manifest_file_name = base_file_name + "_manifest.json"
+
+        self.partial_line = ""
+        self.shards = []
+        if number_of_shards:
+            for i in range(number_of_shards):
+                self._open_next_shard()
+        else:
+            self._open_next_shard()
+
+    def _open_next_shard(self):
+        shard_file_name = self.shard_file_name_template % len(self.shards)
+        self.shards.append({"file_name": shard_file_name, "fp": self.open_shard(shard_file_name),
+                            "md5": hashlib.md5(), "triples": 0, "bytes": 0, "pending": []})
+
+    def _flush_shard(self, shard):
+        if shard["pending"]:
+            shard["fp"].write("".join(shard["pending"]))
+            shard["pending"] = []
+
+    def _close_shard(self, shard):
+        if shard["fp"] is not None:
+            self._flush_shard(shard)
+            shard["fp"].close()
+            shard["fp"] = None
+
+    def _shard_for_line(self, line):
+        if self.number_of_shards:
+            subject_term = line[:line.find(" ")]
+            shard_number = (zlib.crc32(subject_term.encode("utf-8")) & 0xffffffff) % self.number_of_shards
+            return self.shards[shard_number]
+        else:
+            shard = self.shards[-1]
+            if (self.max_shard_triples and shard["triples"] >= self.max_shard_triples) or \
+                    (self.max_shard_bytes and shard["bytes"] >= self.max_shard_bytes):
+                self._close_shard(shard)
+                self._open_next_shard()
+                shard = self.shards[-1]
+            return shard
+
+    def write(self, text):
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+
+        for line in lines:
+            if line.strip():
+                shard = self._shard_for_line(line)
+                line += "\n"
+                encoded_line = line.encode("utf-8")
+                shard["md5"].update(encoded_line)
+                shard["triples"] += 1
+                shard["bytes"] += len(encoded_line)
+                shard["pending"].append(line)
+
+        for shard in self.shards:
+            if shard["fp"] is not None:
+                self._flush_shard(shard)
+
+    def close(self):
+        if self.partial_line.strip():
+            self.write("\n")
+
+        manifest = {"file_name": os.path.basename(self.file_name), "triples": 0, "shards": []}
+        if self.number_of_shards:
+            manifest["sharding"] = "subject_hash"
+        else:
+            manifest["sharding"] = "size"
+
+        for shard in self.shards:
+            self._close_shard(shard)
+            manifest["shards"].append({"file_name": os.path.basename(shard["file_name"]),
+                                       "triples": shard["triples"], "bytes": shard["bytes"],
+                                       "md5": shard["md5"].hexdigest()})
+            manifest["triples"] += shard["triples"]
+
+        with open(self.manifest_file_name, "w") as fj:
+            json.dump(manifest, fj, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def triple_fingerprint(line):
+    """A 64 bit fingerprint of a line of N-Triples ignoring trailing whitespace"""
+    return struct.unpack("<Q", hashlib.md5(line.rstrip().encode("utf-8")).digest()[:8])[0]
+
+
+class TripleFingerprintSet(object):
+    """Exact set of 64 bit triple fingerprints. The fingerprints are kept in an open addressed hash table of two
+    packed arrays of 32 bit halves, so each triple costs 8 bytes per slot whatever the length of the triple."""
+    def __init__(self, initial_capacity=1 << 16):
+        number_of_slots = 1
+        while number_of_slots < 2 * initial_capacity:
+            number_of_slots <<= 1
+        self._allocate(number_of_slots)
+        self.number_of_fingerprints = 0
+        # An all zero slot is empty, so the zero fingerprint is tracked separately
+        self.has_zero_fingerprint = False
+
+    def _allocate(self, number_of_slots):
+        self.slot_mask = number_of_slots - 1
+        self.high_words = array.array("I", [0]) * number_of_slots
+        self.low_words = array.array("I", [0]) * number_of_slots
+
+    def _insert(self, high_word, low_word):
+        slot = low_word & self.slot_mask
+        while True:
+            slot_high_word = self.high_words[slot]
+            slot_low_word = self.low_words[slot]
+            if slot_high_word == 0 and slot_low_word == 0:
+                self.high_words[slot] = high_word
+                self.low_words[slot] = low_word
+                return True
+            elif slot_high_word == high_word and slot_low_word == low_word:
+                return False
+            slot = (slot + 1) & self.slot_mask
+
+    def _grow(self):
+        high_words = self.high_words
+        low_words = self.low_words
+        self._allocate(2 * len(high_words))
+        for high_word, low_word in zip(high_words, low_words):
+            if high_word or low_word:
+                self._insert(high_word, low_word)
+
+    def add_line(self, line):
+        """Add a line of N-Triples and return True when it has not been seen before"""
+        fingerprint = triple_fingerprint(line)
+        if fingerprint == 0:
+            if self.has_zero_fingerprint:
+                return False
+            self.has_zero_fingerprint = True
+            return True
+
+        if not self._insert(fingerprint >> 32, fingerprint & 0xffffffff):
+            return False
+        self.number_of_fingerprints += 1
+        if 2 * self.number_of_fingerprints > len(self.high_words):
+            self._grow()
+        return True
+
+    def __len__(self):
+        return self.number_of_fingerprints + (1 if self.has_zero_fingerprint else 0)
+
+
+class BloomTripleFilter(object):
+    """A Bloom filter over triple fingerprints sized for capacity triples at the given false positive rate. On its
+    own it may drop a small fraction of unique triples. With spill_file_name set every fingerprint is also stored
+    in a SQLite file on disk and possible duplicates are checked there, so no triple is dropped by mistake. New
+    fingerprints are written to the spill file in batches of batch_size. An existing spill file is emptied when
+    the filter is created."""
+    def __init__(self, capacity, error_rate=0.001, spill_file_name=None, batch_size=DEFAULT_STORE_BATCH_SIZE):
+        if capacity < 1:
+            raise ValueError("Bloom filter capacity must be at least 1, got %r" % (capacity,))
+        if not 0 < error_rate < 1:
+            raise ValueError("Bloom filter error rate must be between 0 and 1, got %r" % (error_rate,))
+
+        self.number_of_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.number_of_hashes = max(1, int(round(self.number_of_bits * math.log(2) / capacity)))
+        self.bits = bytearray((self.number_of_bits + 7) // 8)
+
+        self.spill_file_name = spill_file_name
+        self.batch_size = batch_size
+        self.pending_fingerprints = sets.Set()
+        if spill_file_name is not None:
+            import sqlite3
+            self.connection = sqlite3.connect(spill_file_name, check_same_thread=False)
+            self.connection.execute("PRAGMA synchronous = OFF")
+            self.connection.execute("DROP TABLE IF EXISTS fingerprints")
+            self.connection.execute("CREATE TABLE fingerprints (fingerprint INTEGER PRIMARY KEY)")
+        else:
+            self.connection = None
+
+    def _bit_positions(self, fingerprint):
+        first_hash = fingerprint & 0xffffffff
+        second_hash = (fingerprint >> 32) | 1
+        return [(first_hash + i * second_hash) % self.number_of_bits for i in range(self.number_of_hashes)]
+
+    def add_line(self, line):
+        """Add a line of N-Triples and return True when it has not been seen before"""
+        fingerprint = triple_fingerprint(line)
+        maybe_seen = True
+        bits = self.bits
+        for position in self._bit_positions(fingerprint):
+            byte_index = position >> 3
+            bit_mask = 1 << (position & 7)
+            if not bits[byte_index] & bit_mask:
+                maybe_seen = False
+                bits[byte_index] |= bit_mask
+
+        if self.connection is None:
+            return not maybe_seen
+
+        # SQLite integers are signed 64 bit
+        signed_fingerprint = fingerprint - (1 << 64) if fingerprint >= (1 << 63) else fingerprint
+        if maybe_seen:
+            # Only a possible duplicate is looked up, in the pending batch first and then on disk
+            if signed_fingerprint in self.pending_fingerprints:
+                return False
+            if self.connection.execute("SELECT 1 FROM fingerprints WHERE fingerprint = ?",
+                                       (signed_fingerprint,)).fetchone():
+                return False
+
+        self.pending_fingerprints.add(signed_fingerprint)
+        if len(self.pending_fingerprints) >= self.batch_size:
+            self._flush_pending()
+        return True
+
+    def _flush_pending(self):
+        if self.pending_fingerprints:
+            self.connection.executemany("INSERT OR IGNORE INTO fingerprints (fingerprint) VALUES (?)",
+                                        [(fingerprint,) for fingerprint in sorted(self.pending_fingerprints)])
+            self.pending_fingerprints.clear()
+
+    def close(self):
+        if self.connection is not None:
+            self._flush_pending()
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
+
+
+class DeduplicatingTripleWriter(object):
+    """A file like object which only passes on N-Triples lines whose fingerprint has not been seen before. The
+    fingerprint set can be shared between writers to de-duplicate across files."""
+    def __init__(self, fp, triple_fingerprints):
+        self.fp = fp
+        self.triple_fingerprints = triple_fingerprints
+        self.partial_line = ""
+
+    def write(self, text):
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+
+        new_lines = []
+        for line in lines:
+            line = line.rstrip()
+            if line and self.triple_fingerprints.add_line(line):
+                new_lines.append(line + "\n")
+        if new_lines:
+            self.fp.write("".join(new_lines))
+
+    def close(self):
+        if self.partial_line.strip():
+            self.write("\n")
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TripleOutputOptions(object):
+    """Output settings shared by the classes which write N-Triples files"""
+    pipeline_queue_depth = None
+    triple_store = None
+    shard_options = None
+    triple_fingerprints = None
+
+    def set_pipelined_output(self, queue_depth=DEFAULT_PIPELINE_QUEUE_DEPTH):
+        """Write triples on a separate thread through a queue holding at most queue_depth batches. None turns
+        pipelining off."""
+        self.pipeline_queue_depth = queue_depth
+
+    def set_triple_store(self, triple_store):
+        """Load triples directly into triple_store, e.g. a SQLiteTripleStore, instead of writing N-Triples files.
+        Each file becomes a graph named after the file. The lookup indexes of a SQLiteTripleStore are built when
+        it is closed."""
+        self.triple_store = triple_store
+
+    def set_sharded_output(self, number_of_shards=None, max_shard_triples=None, max_shard_bytes=None):
+        """Split each N-Triples file into shards by a hash of the subject URI when number_of_shards is given, or
+        by size with max_shard_triples or max_shard_bytes. Together with set_pipelined_output each shard is written
+        on its own thread. Calling it without arguments turns sharding off."""
+        if number_of_shards or max_shard_triples or max_shard_bytes:
+            self.shard_options = {"number_of_shards": number_of_shards, "max_shard_triples": max_shard_triples,
+                                  "max_shard_bytes": max_shard_bytes}
+        else:
+            self.shard_options = None
+
+    def set_triple_deduplication(self, triple_fingerprints):
+        """Drop triples already seen in triple_fingerprints, a TripleFingerprintSet or a BloomTripleFilter. Pass
+        the same object to several writers to de-duplicate across their files and None to turn it off."""
+        self.triple_fingerprints = triple_fingerprints
+
+    def _open_triple_file(self, file_name):
+        if self.triple_fingerprints is not None:
+            return DeduplicatingTripleWriter(self._open_triple_sink(file_name), self.triple_fingerprints)
+        else:
+            return self._open_triple_sink(file_name)
+
+    def _open_triple_sink(self, file_name):
+        if self.triple_store is not None:
+            graph = os.path.splitext(os.path.basename(file_name))[0]
+            return self._pipeline(self.triple_store.graph_writer(graph))
+        elif self.shard_options is not None:
+            return ShardedTripleWriter(file_name, self._open_single_triple_file, **self.shard_options)
+        else:
+            return self._open_single_triple_file(file_name)
+
+    def _open_single_triple_file(self, file_name):
+        return self._pipeline(codecs.open(file_name, "w", "utf-8"))
+
+    def _pipeline(self, fp):
+        if self.pipeline_queue_depth:
+            return PipelinedTripleWriter(fp, self.pipeline_queue_depth)
+        else:
+            return fp
+
+
+NTRIPLES_ESCAPES = {u"\\": u"\\\\", u'"': u'\\"', u"\n": u"\\n", u"\r": u"\\r", u"\t": u"\\t"}
+NTRIPLES_UNESCAPED_PATTERN = re.compile(u'[\ud800-\udbff][\udc00-\udfff]|[^\\x20\\x21\\x23-\\x5b\\x5d-\\x7e]')
+
+
+def _escape_ntriples_character(match):
+    characters = match.group(0)
+    if characters in NTRIPLES_ESCAPES:
+        return NTRIPLES_ESCAPES[characters]
+    if len(characters) == 2:  # Surrogate pair on narrow Python builds
+        code_point = 0x10000 + ((ord(characters[0]) - 0xd800) << 10) + (ord(characters[1]) - 0xdc00)
+    else:
+        code_point = ord(characters)
+    if code_point > 0xffff:
+        return u"\\U%08X" % code_point
+    else:
+        return u"\\u%04X" % code_point
+
+
+def escape_ntriples_literal(literal):
+    """Escape a string for the inside of an N-Triples literal: quotes, backslashes, control characters and
+    everything outside of ASCII"""
+    return NTRIPLES_UNESCAPED_PATTERN.sub(_escape_ntriples_character, literal)
+
+
+class LiteralTable(object):
+    """Builds each distinct label literal once however many AUIs repeat it. Labels are keyed on their UMLS SUI and
+    LAT, so the label text itself is not kept a second time. A table is meant to live for one output file. Language
+    tags come from the UMLS LAT of the source."""
+    def __init__(self, default_language="en"):
+        self.default_language = default_language
+        self.language_literals = {}
+
+    def language_tag(self, lat):
+        if lat is None:
+            return self.default_language
+        return UMLS_LANGUAGE_TAGS.get(lat, lat.lower())
+
+    def literal(self, literal, lat=None, sui=None):
+        """Returns a complete N-Triples literal with a language tag, e.g. "Cholera"@en. Literals without a sui are
+        not kept."""
+        if sui is None:
+            return u'"%s"@%s' % (escape_ntriples_literal(literal), self.language_tag(lat))
+
+        key = (sui, lat)
+        if key not in self.language_literals:
+            self.language_literals[key] = u'"%s"@%s' % (escape_ntriples_literal(literal), self.language_tag(lat))
+        return self.language_literals[key]
+
+
+_precompiled_cache = {}
+
+
+def clear_precompiled_cache():
+    """Drops the results load_precompiled keeps in memory"""
+    _precompiled_cache.clear()
+
+
+def load_precompiled(source_file_name, build_function, keep_in_memory=True):
+    """Returns build_function(source_file_name) using a pickled copy kept next to the source file. The pickle
+    records the size and modification time of the source and is only used while both match exactly. With
+    keep_in_memory the result is also kept in memory for the rest of the run, see clear_precompiled_cache."""
+    source_signature = (os.path.getsize(source_file_name), os.path.getmtime(source_file_name))
+    cache_key = (os.path.abspath(source_file_name), build_function)
+    if cache_key in _precompiled_cache and _precompiled_cache[cache_key][0] == source_signature:
+        return _precompiled_cache[cache_key][1]
+
+    pickle_file_name = source_file_name + ".pickle"
+    result = None
+    if os.path.exists(pickle_file_name):
+        try:
+            with open(pickle_file_name, "rb") as fp:
+                pickled = cPickle.load(fp)
+            if isinstance(pickled, tuple) and len(pickled) == 2 and pickled[0] == source_signature:
+                result = pickled[1]
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError, ImportError, AttributeError, IndexError,
+                TypeError, KeyError):
+            logging.warning("Cannot read '%s', rebuilding it", os.path.abspath(pickle_file_name))
+
+    if result is None:
+        result = build_function(source_file_name)
+        try:
+            with open(pickle_file_name, "wb") as fp:
+                cPickle.dump((source_signature, result), fp, cPickle.HIGHEST_PROTOCOL)
+        except IOError:
+            logging.warning("Cannot write '%s'", os.path.abspath(pickle_file_name))
+
+    if keep_in_memory:
+        _precompiled_cache[cache_key] = (source_signature, result)
+    return result
+
+
+def load_json(file_name):
+    with open(file_name) as fj:
+        return json.load(fj)
+
+
+def _read_file_layout_json(file_name):
     fj = open(file_name, "r")
     file_layout_json = json.load(fj)
 
@@ -62,6 +781,10 @@ def read_file_layout(file_name):
     return file_layout_json_cleaned
 
 
+def read_file_layout(file_name):
+    return load_precompiled(file_name, _read_file_layout_json)
+
+
 def transform_to_url(string_to_transform):
     """Transform a string to be more URL friendly"""
 
@@ -73,7 +796,7 @@ def transform_to_url(string_to_transform):
     return s4
 
 
-class UMLSJsonToISFSKOS(object):
+class UMLSJsonToISFSKOS(TripleOutputOptions):
     """A class for transform JSON extracted from RRF files from the UMLS into a SKOS ISF compatible format"""
     def __init__(self, aui_json_file_name, sab_json_file_name="sab_umls.json"):
         self.aui_json_file_name = aui_json_file_name
@@ -104,6 +827,7 @@ class UMLSJsonToISFSKOS(object):
         self.skos_top_concept_of = self.prefixes["skos"] + "topConceptOf"
         self.skos_notation = self.prefixes["skos"] + "notation"
         self.skos_broader = self.prefixes["skos"] + "broader"
+        self.skos_broader_transitive = self.prefixes["skos"] + "broaderTransitive"
         self.skos_narrower = self.prefixes["skos"] + "narrower"
         self.skos_preferred_label = self.prefixes["skos"] + "prefLabel"
         self.skos_collection = self.prefixes["skos"] + "Collection"
@@ -115,19 +839,35 @@ class UMLSJsonToISFSKOS(object):
         #SKOSXL
         self.skosxl_literal_form = self.prefixes["skosxl"] + "literalForm"
 
-        self._load_json_files()
-        self._generate_helper_dicts()
-
-    def _load_json_files(self):
-        with open(self.aui_json_file_name) as fj:
-            self.umls_dict = json.load(fj)
-
-        with open(self.sab_json_file_name) as fj:
-            self.sab_dict = json.load(fj)
-
-    def _generate_helper_dicts(self):
-        self.cui_dict = self.dict_by_umls_cui(self.umls_dict)
-        self.code_dict = self.dict_by_source_code(self.umls_dict)
+        # The JSON files and helper dicts are loaded on first use
+        self._umls_dict = None
+        self._sab_dict = None
+        self._cui_dict = None
+        self._code_dict = None
+
+    @property
+    def umls_dict(self):
+        if self._umls_dict is None:
+            self._umls_dict = load_precompiled(self.aui_json_file_name, load_json, keep_in_memory=False)
+        return self._umls_dict
+
+    @property
+    def sab_dict(self):
+        if self._sab_dict is None:
+            self._sab_dict = load_precompiled(self.sab_json_file_name, load_json, keep_in_memory=False)
+        return self._sab_dict
+
+    @property
+    def cui_dict(self):
+        if self._cui_dict is None:
+            self._cui_dict = self.dict_by_umls_cui(self.umls_dict)
+        return self._cui_dict
+
+    @property
+    def code_dict(self):
+        if self._code_dict is None:
+            self._code_dict = self.dict_by_source_code(self.umls_dict)
+        return self._code_dict
 
     def set_broader_relationship_field(self, key="REL", value="PAR"):
         self.broader_key = key
@@ -187,87 +927,97 @@ class UMLSJsonToISFSKOS(object):
         return self.base_uri + "l_" + self.concept_abbreviation + "_" + sui
 
     def write_to_out_file(self, file_name="skos_output.nt"):
-        sui_dict = {}  #TODO: For SUIs do not create duplicates
-        with codecs.open(file_name, "w", "utf-8") as ft:
+        suis_written = sets.Set()
+        # The label literals are only kept while this file is written
+        literal_table = LiteralTable()
+        with self._open_triple_file(file_name) as ft:
 
             ft.write("<%s> <%s> <%s> .\n" % (self.scheme_uri(), self.rdf_type, self.skos_concept_scheme))
-            ft.write('<%s> <%s> "%s"@en .\n' % (self.scheme_uri(), self.dc_title,
-                                                 self._escape_literal(self.concept_abbreviation)))
-            ft.write('<%s> <%s> "%s"@en .\n' % (self.scheme_uri(), self.dc_subject, "Mapping UMLS vocabulary to SKOS"))
-            ft.write('<%s> <%s> "%s"@en .\n' % (self.scheme_uri(), self.dc_creator, "script"))
+            ft.write('<%s> <%s> %s .\n' % (self.scheme_uri(), self.dc_title,
+                                            literal_table.literal(self.concept_abbreviation)))
+            ft.write('<%s> <%s> %s .\n' % (self.scheme_uri(), self.dc_subject,
+                                            literal_table.literal("Mapping UMLS vocabulary to SKOS")))
+            ft.write('<%s> <%s> %s .\n' % (self.scheme_uri(), self.dc_creator, literal_table.literal("script")))
 
-            ft.write('<%s> <%s> "%s"@en .\n' % (self.scheme_uri(), self.rdfs_label,
-                                                 self._escape_literal(self.concept_abbreviation)))
+            ft.write('<%s> <%s> %s .\n' % (self.scheme_uri(), self.rdfs_label,
+                                            literal_table.literal(self.concept_abbreviation)))
 
             auis_left_relationship = []
             auis_right_relationship = []
 
-            for aui in self.umls_dict.keys():
-                aui_dict = self.umls_dict[aui]
-                code = aui_dict["CODE"]
-                label = aui_dict["STR"]
-                cui = aui_dict["CUI"]
+            for code in self.code_dict.keys():
                 concept_uri = self.concept_uri(code)
-                sui = aui_dict["SUI"]
 
+                # Triples about the code are written once however many AUIs share the code
                 ntriples = ""
                 ntriples += "<%s> <%s> <%s> .\n" % (concept_uri, self.rdf_type, self.skos_concept)
                 ntriples += "<%s> <%s> <%s> . \n" % (concept_uri, self.skos_is_in_scheme, self.scheme_uri())
                 ntriples += '<%s> <%s> "%s"^^<%s> . \n' % (concept_uri, self.skos_notation,
                                                              self._escape_literal(code), self.code_data_type())
-                ntriples += '<%s> <%s> "%s"@en . \n' % (concept_uri, self.skos_preferred_label,
-                                                             self._escape_literal(label))
-                ntriples += '<%s> <%s> "%s"^^<%s> . \n' % (concept_uri, self.skos_notation, self._escape_literal(cui),self.umls_cui_data_type())
-                ntriples += '<%s> <%s> "%s"^^<%s> . \n' % (concept_uri, self.skos_notation, self._escape_literal(aui),self.umls_aui_data_type())
-
-                ntriples += '<%s> <%s> <%s> .\n' % (concept_uri, self.rdfs_see_also, self.aui_external_uri + aui)
-
-                sui_uri = self.umls_sui_uri(sui)
-                ntriples += '<%s> <%s> <%s> . \n' % (concept_uri, self.skos_preferred_label, sui_uri)
-
-                if sui in sui_dict:
-                    pass
-                else:
-                    sui_dict[sui] = label
-                    ntriples += "<%s> <%s> <%s> .\n" % (sui_uri, self.rdf_type, self.skosxl_literal_form)
-                    ntriples += '<%s> <%s> "%s"@en .\n' % (sui_uri, self.rdfs_label, self._escape_literal(label))
-
-                if "definition" in aui_dict:
-                    definition = aui_dict["definition"]
-                    ntriples += '<%s> <%s> "%s"@en .\n' % (concept_uri, self.skos_definition,
-                                                         self._escape_literal(definition))
-
-                if "relationships" in aui_dict:
-                    for relationship in aui_dict["relationships"]:
-                        if relationship[self.broader_key] == self.broader_value:
-                            if "AUI2" in relationship:
-                                aui_code_to_link_to = relationship["AUI2"]
-                                if aui_code_to_link_to in self.umls_dict:
-                                    aui_to_link_to = self.umls_dict[aui_code_to_link_to]
-                                    concept_uri_to_link_to = self.concept_uri(aui_to_link_to["CODE"])
-                                    ntriples += '<%s> <%s> <%s> .\n' % (concept_uri, self.skos_broader,
-                                                                         concept_uri_to_link_to)
-                                    ntriples += '<%s> <%s> <%s> .\n' % (concept_uri_to_link_to, self.skos_narrower,
-                                                                         concept_uri)
-                                    auis_left_relationship.append(aui)
-                                    auis_right_relationship.append(aui_code_to_link_to)
+                concept_uris_linked_to = []
+                cuis_written = []
+
+                for aui in self.code_dict[code]:
+                    aui_dict = self.umls_dict[aui]
+                    cui = aui_dict["CUI"]
+                    sui = aui_dict["SUI"]
+                    label = literal_table.literal(aui_dict["STR"], aui_dict.get("LAT"), sui)
+
+                    ntriples += '<%s> <%s> %s . \n' % (concept_uri, self.skos_preferred_label, label)
+                    if cui not in cuis_written:
+                        cuis_written.append(cui)
+                        ntriples += '<%s> <%s> "%s"^^<%s> . \n' % (concept_uri, self.skos_notation,
+                                                                     self._escape_literal(cui), self.umls_cui_data_type())
+                    ntriples += '<%s> <%s> "%s"^^<%s> . \n' % (concept_uri, self.skos_notation,
+                                                                 self._escape_literal(aui), self.umls_aui_data_type())
+
+                    ntriples += '<%s> <%s> <%s> .\n' % (concept_uri, self.rdfs_see_also, self.aui_external_uri + aui)
+
+                    sui_uri = self.umls_sui_uri(sui)
+                    ntriples += '<%s> <%s> <%s> . \n' % (concept_uri, self.skos_preferred_label, sui_uri)
+
+                    if sui not in suis_written:
+                        suis_written.add(sui)
+                        ntriples += "<%s> <%s> <%s> .\n" % (sui_uri, self.rdf_type, self.skosxl_literal_form)
+                        ntriples += '<%s> <%s> %s .\n' % (sui_uri, self.rdfs_label, label)
+
+                    if "definition" in aui_dict:
+                        definition = escape_ntriples_literal(aui_dict["definition"])
+                        ntriples += '<%s> <%s> "%s"@%s .\n' % (concept_uri, self.skos_definition, definition,
+                                                              literal_table.language_tag(aui_dict.get("LAT")))
+
+                    if "relationships" in aui_dict:
+                        for relationship in aui_dict["relationships"]:
+                            if relationship[self.broader_key] == self.broader_value:
+                                if "AUI2" in relationship:
+                                    aui_code_to_link_to = relationship["AUI2"]
+                                    if aui_code_to_link_to in self.umls_dict:
+                                        aui_to_link_to = self.umls_dict[aui_code_to_link_to]
+                                        concept_uri_to_link_to = self.concept_uri(aui_to_link_to["CODE"])
+                                        if concept_uri_to_link_to not in concept_uris_linked_to:
+                                            concept_uris_linked_to.append(concept_uri_to_link_to)
+                                            ntriples += '<%s> <%s> <%s> .\n' % (concept_uri, self.skos_broader,
+                                                                                 concept_uri_to_link_to)
+                                            ntriples += '<%s> <%s> <%s> .\n' % (concept_uri_to_link_to,
+                                                                                 self.skos_narrower, concept_uri)
+                                        auis_left_relationship.append(aui)
+                                        auis_right_relationship.append(aui_code_to_link_to)
                 ft.write(ntriples)
 
             set_left = sets.Set(auis_left_relationship)
             set_right = sets.Set(auis_right_relationship)
 
             top_auis = set_right - set_left
+            top_concept_uris = sets.Set([self.concept_uri_from_aui(top_aui) for top_aui in top_auis])
 
-            for top_aui in top_auis:
-                top_concept_uri = self.concept_uri_from_aui(top_aui)
+            ntriples = ""
+            for top_concept_uri in top_concept_uris:
                 ntriples += "<%s> <%s> <%s> .\n" % (self.scheme_uri(), self.skos_has_top_concept, top_concept_uri)
                 ntriples += "<%s> <%s> <%s> .\n" % (top_concept_uri, self.skos_top_concept_of, self.scheme_uri())
             ft.write(ntriples)
 
     def _escape_literal(self, literal):
-        if '"' in literal:
-            literal = string.join(literal.split('"'), r'\"')
-        return literal
+        return escape_ntriples_literal(literal)
 
     def set_aui_external_uri(self, uri):
         self.aui_external_uri = uri
@@ -292,8 +1042,174 @@ class UMLSJsonToISFSKOS(object):
                 code_dict[code] = [aui]
         return code_dict
 
+    def broader_code_dict(self):
+        """Returns a dict of source code to the codes of its direct broader concepts"""
+        broader_codes = {}
+        for aui in self.umls_dict:
+            aui_dict = self.umls_dict[aui]
+            code_broader_codes = broader_codes.setdefault(aui_dict["CODE"], [])
+            if "relationships" in aui_dict:
+                for relationship in aui_dict["relationships"]:
+                    if relationship[self.broader_key] == self.broader_value:
+                        if "AUI2" in relationship and relationship["AUI2"] in self.umls_dict:
+                            broader_code = self.umls_dict[relationship["AUI2"]]["CODE"]
+                            if broader_code not in code_broader_codes:
+                                code_broader_codes.append(broader_code)
+        return broader_codes
+
+    def topological_code_order(self, broader_codes=None):
+        """Returns the codes ordered so that each code comes after all of its broader concepts together with the
+        list of codes which are in or below a cycle and so cannot be ordered"""
+        if broader_codes is None:
+            broader_codes = self.broader_code_dict()
+        codes = sorted(broader_codes)
+
+        narrower_codes = dict((code, []) for code in codes)
+        parents_left = {}
+        for code in codes:
+            parents = [parent for parent in broader_codes[code] if parent != code]
+            parents_left[code] = len(parents)
+            for parent in parents:
+                narrower_codes[parent].append(code)
+
+        ordered_codes = []
+        ready_codes = collections.deque(code for code in codes if parents_left[code] == 0)
+        while ready_codes:
+            code = ready_codes.popleft()
+            ordered_codes.append(code)
+            for child in narrower_codes[code]:
+                parents_left[child] -= 1
+                if parents_left[child] == 0:
+                    ready_codes.append(child)
+
+        cycle_codes = [code for code in codes if parents_left[code] > 0]
+        if cycle_codes:
+            logging.warning("%s codes in %s are in or below a cycle in the hierarchy", len(cycle_codes),
+                            self.concept_abbreviation)
+        return ordered_codes, cycle_codes
+
+    def ancestor_index(self):
+        """Returns a sorted list of codes and a list in the same order holding for each code an array of the sorted
+        positions in codes of all its broader concepts. Arrays are built top down in topological order by merging
+        the arrays of the direct parents, so memory grows with the number of ancestor links rather than with the
+        square of the number of codes. Codes with several parents get the union over all paths and codes in a
+        cycle get the ancestors of the whole cycle."""
+        broader_codes = self.broader_code_dict()
+        ordered_codes, cycle_codes = self.topological_code_order(broader_codes)
+        codes = sorted(broader_codes)
+        code_ids = dict((code, i) for i, code in enumerate(codes))
+
+        ancestor_ids = [None] * len(codes)
+        for code in ordered_codes:
+            parents = [parent for parent in broader_codes[code] if parent != code]
+            if len(parents) == 1:
+                code_ancestor_ids = array.array("i", ancestor_ids[code_ids[parents[0]]])
+                bisect.insort(code_ancestor_ids, code_ids[parents[0]])
+            else:
+                ancestor_id_set = sets.Set()
+                for parent in parents:
+                    ancestor_id_set.add(code_ids[parent])
+                    ancestor_id_set.update(ancestor_ids[code_ids[parent]])
+                code_ancestor_ids = array.array("i", sorted(ancestor_id_set))
+            ancestor_ids[code_ids[code]] = code_ancestor_ids
+
+        cycle_ancestor_ids = dict((code, sets.Set()) for code in cycle_codes)
+        changed = True
+        while changed and cycle_codes:
+            changed = False
+            for code in cycle_codes:
+                code_ancestor_ids = sets.Set(cycle_ancestor_ids[code])
+                for parent in broader_codes[code]:
+                    code_ancestor_ids.add(code_ids[parent])
+                    if parent in cycle_ancestor_ids:
+                        code_ancestor_ids.update(cycle_ancestor_ids[parent])
+                    else:
+                        code_ancestor_ids.update(ancestor_ids[code_ids[parent]])
+                code_ancestor_ids.discard(code_ids[code])
+                if code_ancestor_ids != cycle_ancestor_ids[code]:
+                    cycle_ancestor_ids[code] = code_ancestor_ids
+                    changed = True
+        for code in cycle_codes:
+            ancestor_ids[code_ids[code]] = array.array("i", sorted(cycle_ancestor_ids[code]))
+
+        return codes, ancestor_ids
+
+    def nearest_in_hierarchy(self, own_value, broader_codes=None, code_order=None):
+        """For each code finds the closest of itself and its ancestors for which own_value(code) is not None.
+        Returns a dict of code to a (distance, value) tuple, or None when no such code exists. Ties between
+        several parents are broken on the smallest value. code_order is the result of topological_code_order
+        when the caller already has it."""
+        if broader_codes is None:
+            broader_codes = self.broader_code_dict()
+        if code_order is None:
+            code_order = self.topological_code_order(broader_codes)
+        ordered_codes, cycle_codes = code_order
+        nearest = {}
+
+        def closest(code):
+            value = own_value(code)
+            if value is not None:
+                return 0, value
+            closest_found = None
+            for parent in broader_codes[code]:
+                if parent != code and nearest.get(parent) is not None:
+                    candidate = (nearest[parent][0] + 1, nearest[parent][1])
+                    if closest_found is None or candidate < closest_found:
+                        closest_found = candidate
+            return closest_found
+
+        for code in ordered_codes:
+            nearest[code] = closest(code)
+
+        changed = True
+        while changed and cycle_codes:
+            changed = False
+            for code in cycle_codes:
+                closest_found = closest(code)
+                if closest_found != nearest.get(code):
+                    nearest[code] = closest_found
+                    changed = True
+
+        return nearest
+
+    def code_depth_dict(self, broader_codes=None, code_order=None):
+        """Returns a dict of code to its shortest distance from a top concept"""
+        if broader_codes is None:
+            broader_codes = self.broader_code_dict()
+
+        def top_concept(code):
+            if not [parent for parent in broader_codes[code] if parent != code]:
+                return code
+
+        nearest_top = self.nearest_in_hierarchy(top_concept, broader_codes, code_order)
+        return dict((code, nearest_top[code][0]) for code in nearest_top if nearest_top[code] is not None)
+
+    def ancestor_closure(self):
+        """Returns a dict of source code to a sorted tuple of the codes of all its broader concepts"""
+        codes, ancestor_ids = self.ancestor_index()
+        return dict((code, tuple([codes[i] for i in ancestor_ids[j]])) for j, code in enumerate(codes))
+
+    def write_transitive_closure_file(self, file_name="skos_transitive_output.nt"):
+        """Write a skos:broaderTransitive triple from each concept to every one of its ancestors"""
+        codes, ancestor_ids = self.ancestor_index()
+        concept_uris = [self.concept_uri(code) for code in codes]
+        with self._open_triple_file(file_name) as ft:
+            for j, concept_uri in enumerate(concept_uris):
+                ntriples = ""
+                for i in ancestor_ids[j]:
+                    ntriples += "<%s> <%s> <%s> .\n" % (concept_uri, self.skos_broader_transitive, concept_uris[i])
+                ft.write(ntriples)
+
+    def write_ancestor_index_file(self, file_name="ancestor_index.json"):
+        """Write the ancestor index as JSON with the sorted codes and for each code the list of positions of its
+        ancestors in the codes list"""
+        codes, ancestor_ids = self.ancestor_index()
+        with open(file_name, "w") as fj:
+            json.dump({"codes": codes, "ancestors": [code_ancestor_ids.tolist() for code_ancestor_ids in ancestor_ids]},
+                      fj)
 
-class UMLS2SKOSCrossVocabulary(object):
+
+class UMLS2SKOSCrossVocabulary(TripleOutputOptions):
     """Creates mapping files in SKOS and annotations to original SKOS file based on a mapping file"""
 
     def __init__(self, mapping_file, umls_skos_obj_from, umls_skos_obj_to, source_code = "S_CODE", destination_code = "Post_Code", source_cui = "S_CUI"):
@@ -305,15 +1221,25 @@ class UMLS2SKOSCrossVocabulary(object):
         self._generate_dictionaries()
 
     def _generate_dictionaries(self):
-        self.umls_cui_from = self.umls_skos_obj_from.dict_by_umls_cui(self.umls_skos_obj_from.umls_dict)
-        self.umls_cui_to = self.umls_skos_obj_to.dict_by_umls_cui(self.umls_skos_obj_to.umls_dict)
+        self.umls_cui_from = self.umls_skos_obj_from.cui_dict
+        self.umls_cui_to = self.umls_skos_obj_to.cui_dict
 
-        self.code_from = self.umls_skos_obj_from.dict_by_source_code(self.umls_skos_obj_from.umls_dict)
-        self.code_to = self.umls_skos_obj_to.dict_by_source_code(self.umls_skos_obj_to.umls_dict)
+        self.code_from = self.umls_skos_obj_from.code_dict
+        self.code_to = self.umls_skos_obj_to.code_dict
 
     def _load_mapping_file(self):
-        with open(self.mapping_file, "r") as f:
-            self.mapping_file_read = list(csv.DictReader(f))
+        if self.mapping_file is None:
+            self.mapping_file_read = None
+        else:
+            with open(self.mapping_file, "r") as f:
+                self.mapping_file_read = list(csv.DictReader(f))
+
+    def _mapping_rows(self):
+        """Rows of the mapping file or when no mapping file was given rows generated from the two vocabularies"""
+        if self.mapping_file_read is None:
+            return generate_mapping_rows(self.umls_skos_obj_from, self.umls_skos_obj_to)
+        else:
+            return self.mapping_file_read
 
     def write_out_annotation_files(self, directory="../output/"):
         """Write out annotations on each side of the relationship showing common mapping points"""
@@ -330,8 +1256,8 @@ class UMLS2SKOSCrossVocabulary(object):
 
         set_cuis = set_cuis_from.intersection(set_cuis_to)
 
-        ff = open(from_full_file_name, "w")
-        ft = open(to_full_file_name, "w")
+        ff = self._open_triple_file(from_full_file_name)
+        ft = self._open_triple_file(to_full_file_name)
 
         for cui in set_cuis:
             auis_from = self.umls_cui_from[cui]
@@ -346,8 +1272,8 @@ class UMLS2SKOSCrossVocabulary(object):
                 data_type_uri = self.umls_skos_obj_to.code_data_type()
 
                 for code in code_list:
-                    ff.write('<%s> <%s> "%s"^^<%s> . \n' % (aui_from_uri, self.umls_skos_obj_from.skos_notation, code,
-
+                    ff.write('<%s> <%s> "%s"^^<%s> . \n' % (aui_from_uri, self.umls_skos_obj_from.skos_notation,
+                                                            self.umls_skos_obj_to._escape_literal(code),
                                                             data_type_uri))
 
             for aui_to in auis_to: # Generate annotations in the other direction
@@ -359,7 +1285,8 @@ class UMLS2SKOSCrossVocabulary(object):
                 data_type_uri = self.umls_skos_obj_from.code_data_type()
 
                 for code in code_list:
-                    ft.write('<%s> <%s> "%s"^^<%s> . \n' % (aui_to_uri, self.umls_skos_obj_to.skos_notation, code,
+                    ft.write('<%s> <%s> "%s"^^<%s> . \n' % (aui_to_uri, self.umls_skos_obj_to.skos_notation,
+                                                            self.umls_skos_obj_from._escape_literal(code),
                                                             data_type_uri))
 
         ff.close()
@@ -376,8 +1303,8 @@ class UMLS2SKOSCrossVocabulary(object):
         mapping_file_name = sab_from + "_mapped_to_" + sab_to + ".nt"
         mapping_full_file_name = os.path.join(full_directory, mapping_file_name)
 
-        with open(mapping_full_file_name, "w") as f:
-            for mapping in self.mapping_file_read:
+        with self._open_triple_file(mapping_full_file_name) as f:
+            for mapping in self._mapping_rows():
                 if mapping["S_CUI"] == mapping["Post_CUI"]:
                     is_approximate_match = True
                 else:
@@ -396,9 +1323,229 @@ class UMLS2SKOSCrossVocabulary(object):
                 f.write("<%s> <%s> <%s> . \n" % (uri_mapped_from, predicate_uri, uri_mapped_to))
 
 
+MAPPING_FILE_FIELDS = ["S_Label", "S_Code", "S_CUI", "S_Depth", "Pre_Label", "Pre-Code", "Pre_CUI", "Pre_Depth",
+                       "Post_Label", "Post_Code", "Post_CUI", "Post_Depth"]
+
+
+def _code_cuis_and_labels(umls_skos_obj):
+    """Returns a dict of code to a list of (CUI, label) pairs from its AUIs in a stable order"""
+    code_cuis = {}
+    for code in umls_skos_obj.code_dict:
+        cuis_and_labels = []
+        seen_cuis = sets.Set()
+        for aui in sorted(umls_skos_obj.code_dict[code]):
+            aui_dict = umls_skos_obj.umls_dict[aui]
+            if aui_dict["CUI"] not in seen_cuis:
+                seen_cuis.add(aui_dict["CUI"])
+                cuis_and_labels.append((aui_dict["CUI"], aui_dict["STR"]))
+        code_cuis[code] = cuis_and_labels
+    return code_cuis
+
+
+def generate_mapping_rows(umls_skos_obj_from, umls_skos_obj_to):
+    """Generate the rows of a fast transition mapping file directly from two extracted vocabularies. For each
+    code of the from vocabulary the nearest of itself and its broader concepts which shares a CUI with the to
+    vocabulary is the pre transition concept and the to vocabulary codes with that CUI are the post transition
+    concepts. The nearest shared CUI is found for all codes in one top down pass over the hierarchy."""
+    from_broader_codes = umls_skos_obj_from.broader_code_dict()
+    from_code_order = umls_skos_obj_from.topological_code_order(from_broader_codes)
+    from_depths = umls_skos_obj_from.code_depth_dict(from_broader_codes, from_code_order)
+
+    to_broader_codes = umls_skos_obj_to.broader_code_dict()
+    to_depths = umls_skos_obj_to.code_depth_dict(to_broader_codes)
+
+    from_code_cuis = _code_cuis_and_labels(umls_skos_obj_from)
+    to_code_cuis = _code_cuis_and_labels(umls_skos_obj_to)
+
+    to_codes_by_cui = {}
+    for code in sorted(to_code_cuis):
+        for cui, label in to_code_cuis[code]:
+            to_codes_by_cui.setdefault(cui, []).append((code, label))
+
+    def shared_cui(code):
+        for cui, label in from_code_cuis[code]:
+            if cui in to_codes_by_cui:
+                return code
+
+    nearest_shared = umls_skos_obj_from.nearest_in_hierarchy(shared_cui, from_broader_codes, from_code_order)
+
+    for code in sorted(nearest_shared):
+        if nearest_shared[code] is None:
+            continue
+
+        start_cui, start_label = from_code_cuis[code][0]
+        pre_code = nearest_shared[code][1]
+        for pre_cui, pre_label in from_code_cuis[pre_code]:
+            if pre_cui in to_codes_by_cui:
+                break
+
+        if pre_code == code:
+            start_cui, start_label = pre_cui, pre_label
+
+        for post_code, post_label in to_codes_by_cui[pre_cui]:
+            yield {"S_Label": start_label, "S_Code": code, "S_CUI": start_cui, "S_Depth": from_depths.get(code, ""),
+                   "Pre_Label": pre_label, "Pre-Code": pre_code, "Pre_CUI": pre_cui,
+                   "Pre_Depth": from_depths.get(pre_code, ""),
+                   "Post_Label": post_label, "Post_Code": post_code, "Post_CUI": pre_cui,
+                   "Post_Depth": to_depths.get(post_code, "")}
+
+
+def write_mapping_file(mapping_file_name, umls_skos_obj_from, umls_skos_obj_to):
+    """Stream generated mapping rows into a CSV file with the same columns as the GraphML generated files"""
+    with open(mapping_file_name, "wb") as f:
+        csv_writer = csv.DictWriter(f, MAPPING_FILE_FIELDS)
+        csv_writer.writeheader()
+        i = 0
+        for row in generate_mapping_rows(umls_skos_obj_from, umls_skos_obj_to):
+            csv_writer.writerow(dict((field, ("%s" % row[field]).encode("utf-8")) for field in MAPPING_FILE_FIELDS))
+            i += 1
+
+    print("Wrote %s mapping rows to '%s'" % (i, mapping_file_name))
+    return mapping_file_name
+
+
+class UMLSVocabularyLookup(object):
+    """Long lived lookups over one or more UMLSJsonToISFSKOS objects: code to concept URI, CUI to codes across
+    vocabularies and code to ancestor codes. The CUI and code indexes and the ancestor closure, as sorted tuples,
+    are built when the lookup is created, and recent CUI results are kept in a bounded LRU cache."""
+    def __init__(self, umls_skos_objs, cache_size=DEFAULT_LOOKUP_CACHE_SIZE):
+        self.vocabularies = collections.OrderedDict()
+        self.ancestors = {}
+        for umls_skos_obj in umls_skos_objs:
+            sab = umls_skos_obj.concept_abbreviation
+            self.vocabularies[sab] = umls_skos_obj
+            # Build the lazy indexes now so concurrent first requests do not each build them
+            umls_skos_obj.cui_dict
+            umls_skos_obj.code_dict
+            self.ancestors[sab] = umls_skos_obj.ancestor_closure()
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def _cached(self, key, compute_function):
+        with self.cache_lock:
+            if key in self.cache:
+                value = self.cache.pop(key)
+                self.cache[key] = value
+                return value
+
+        value = compute_function()
+        with self.cache_lock:
+            self.cache[key] = value
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return value
+
+    def concept_uri(self, sab, code):
+        """Returns the concept URI for a code or None when the code is not in the vocabulary"""
+        umls_skos_obj = self.vocabularies[sab]
+        if code in umls_skos_obj.code_dict:
+            return umls_skos_obj.concept_uri(code)
+
+    def concept_uris(self, sab, codes):
+        return dict((code, self.concept_uri(sab, code)) for code in codes)
+
+    def codes_for_cui(self, cui):
+        """Returns a dict of SAB to the codes which carry the CUI in that vocabulary"""
+        return self._cached(("cui", cui), lambda: self._codes_for_cui(cui))
+
+    def _codes_for_cui(self, cui):
+        codes_by_sab = {}
+        for sab in self.vocabularies:
+            umls_skos_obj = self.vocabularies[sab]
+            if cui in umls_skos_obj.cui_dict:
+                codes = []
+                for aui in umls_skos_obj.cui_dict[cui]:
+                    code = umls_skos_obj.umls_dict[aui]["CODE"]
+                    if code not in codes:
+                        codes.append(code)
+                codes_by_sab[sab] = codes
+        return codes_by_sab
+
+    def codes_for_cuis(self, cuis):
+        return dict((cui, self.codes_for_cui(cui)) for cui in cuis)
+
+    def ancestor_codes(self, sab, code):
+        """Returns a sorted tuple of the codes of all broader concepts of a code"""
+        return self.ancestors[sab].get(code, ())
+
+    def ancestor_codes_for_codes(self, sab, codes):
+        return dict((code, self.ancestor_codes(sab, code)) for code in codes)
+
+
+class VocabularyLookupRequestHandler:
+    """Answers batched lookups as JSON, e.g. /concept_uri?sab=ICD9CM&code=250.00&code=401.9, /cui?cui=C0011849 and
+    /ancestors?sab=ICD9CM&code=250.00. It is mixed into a BaseHTTPRequestHandler by make_vocabulary_lookup_server
+    so the HTTP modules are only imported when serving, and is an old style class like BaseHTTPRequestHandler."""
+    def do_GET(self):
+        import urlparse
+
+        parsed_url = urlparse.urlparse(self.path)
+        parameters = urlparse.parse_qs(parsed_url.query)
+        lookup = self.server.lookup
+
+        try:
+            if parsed_url.path == "/concept_uri":
+                result = lookup.concept_uris(parameters["sab"][0], parameters.get("code", []))
+            elif parsed_url.path == "/cui":
+                result = lookup.codes_for_cuis(parameters.get("cui", []))
+            elif parsed_url.path == "/ancestors":
+                result = lookup.ancestor_codes_for_codes(parameters["sab"][0], parameters.get("code", []))
+            elif parsed_url.path == "/vocabularies":
+                result = list(lookup.vocabularies)
+            else:
+                self.send_error(404)
+                return
+        except KeyError as e:
+            self.send_error(400, "Missing or unknown parameter %s" % e)
+            return
+
+        response = json.dumps(result)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+
+def make_vocabulary_lookup_server(lookup, host="127.0.0.1", port=8765):
+    """Returns a threaded HTTP server answering requests from lookup, a UMLSVocabularyLookup"""
+    import BaseHTTPServer
+    import SocketServer
+
+    class RequestHandler(VocabularyLookupRequestHandler, BaseHTTPServer.BaseHTTPRequestHandler):
+        pass
+
+    class VocabularyLookupHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = VocabularyLookupHTTPServer((host, port), RequestHandler)
+    server.lookup = lookup
+    return server
+
+
+def serve_vocabulary_lookup(umls_skos_objs, host="127.0.0.1", port=8765, cache_size=DEFAULT_LOOKUP_CACHE_SIZE):
+    """Serve lookups over already published vocabularies on a local HTTP endpoint until interrupted"""
+    lookup = UMLSVocabularyLookup(umls_skos_objs, cache_size)
+    server = make_vocabulary_lookup_server(lookup, host, port)
+    print("Serving lookups for %s on http://%s:%s/" % (", ".join(lookup.vocabularies), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 def publish_source_vocabulary(umls_directory="../extract/UMLSMicro2012AB/", sab=["ICD9CM"],
                                      refresh_json_file=False, tty_list=["HT", "PT"],
-                                     hierarchal_relationships=("REL", "PAR")):
+                                     hierarchal_relationships=("REL", "PAR"), pipeline_queue_depth=None,
+                                     triple_store=None, number_of_shards=None, transitive_closure=False,
+                                     triple_fingerprints=None):
 
     if type(sab) != type ([]):
         sab = [sab]
@@ -414,14 +1561,14 @@ def publish_source_vocabulary(umls_directory="../extract/UMLSMicro2012AB/", sab=
     sab_json_file_name = "sab_umls.json"
     sab_json_file_path = os.path.join(umls_directory, sab_json_file_name)
 
-    if os.path.exists(sab_json_file_path):
+    if os.path.exists(sab_json_file_path) and os.path.exists(aui_json_file_path):
         if refresh_json_file:
             refresh = True
     else:
         refresh = True
 
     if refresh:
-        extract_umls_subset_to_json(umls_directory, sab, tty_list)
+        extract_umls_subset_to_json(umls_directory, sab, tty_list, pipeline_queue_depth)
 
     sab_isf_obj = UMLSJsonToISFSKOS(aui_json_file_path, sab_json_file_path)
 
@@ -431,11 +1578,28 @@ def publish_source_vocabulary(umls_directory="../extract/UMLSMicro2012AB/", sab=
     sab_isf_obj.set_aui_external_uri("http://link.informatics.stonybrook.edu/umls/AUI/")
     sab_isf_obj.register_transform_code_function(transform_to_url)
     sab_isf_obj.set_broader_relationship_field(relationship_type, relationship_attribute)
+    sab_isf_obj.set_pipelined_output(pipeline_queue_depth)
+    sab_isf_obj.set_triple_store(triple_store)
+    sab_isf_obj.set_sharded_output(number_of_shards)
+    sab_isf_obj.set_triple_deduplication(triple_fingerprints)
     sab_isf_obj.write_to_out_file("../output/" + sab_name + "_isf_skos.nt")
+    if transitive_closure:
+        sab_isf_obj.write_transitive_closure_file("../output/" + sab_name + "_isf_skos_transitive.nt")
     
     return sab_isf_obj
 
 
+def sab_json_is_current(umls_directory):
+    """True when sab_umls.json exists and is newer than MRSAB.RRF so MRSAB does not need to be scanned again"""
+    json_sab_file_path = os.path.join(umls_directory, "sab_umls.json")
+    mrsab_rrf_file_name = os.path.join(umls_directory, "MRSAB.RRF")
+    if not os.path.exists(json_sab_file_path):
+        return False
+    if not os.path.exists(mrsab_rrf_file_name):
+        return True
+    return os.path.getmtime(json_sab_file_path) >= os.path.getmtime(mrsab_rrf_file_name)
+
+
 def generate_sab_json(umls_directory):
     """Filters SAB list by "SABIN" = 'Y' and creates a dict based on the "RSAB" version"""
     file_layout = read_file_layout("umls_file_layout.json")
@@ -463,101 +1627,114 @@ def generate_sab_json(umls_directory):
     return json_sab_file_path
 
 
-def extract_umls_subset_to_json(umls_directory, SAB=["ICD9CM"], term_types=["HT", "PT"]):
+def extract_umls_subset_to_json(umls_directory, SAB=["ICD9CM"], term_types=["HT", "PT"], pipeline_queue_depth=None):
     """Extract a source vocabulary from RRF and store as JSON"""
 
     print("Extracting source '%s' and term types %s" % (SAB, term_types))
     file_layout = read_file_layout("umls_file_layout.json")
 
-    generate_sab_json(umls_directory)
+    if not sab_json_is_current(umls_directory):
+        generate_sab_json(umls_directory)
 
     mrconso_rrf = "MRCONSO.RRF"
     mrconso_file_layout = file_layout[mrconso_rrf]
     mrconso_rrf_file_name = os.path.join(umls_directory, mrconso_rrf)
-    mrconso = RRFReader(mrconso_rrf_file_name, mrconso_file_layout)
+    mrconso = open_rrf_reader(mrconso_rrf_file_name, mrconso_file_layout, pipeline_queue_depth)
 
     sab_name = "_".join(SAB)
 
     aui_subset = {}
     i = 0
     j = 0
-    for entry in mrconso:
-        sab = entry["SAB"]
-        tty = entry["TTY"]
-        aui = entry["AUI"]
-
-        if sab in SAB:
-            if tty in term_types:
-                aui_subset[aui] = entry
-                j += 1
-        i += 1
+    try:
+        for entry in mrconso:
+            sab = entry["SAB"]
+            tty = entry["TTY"]
+            aui = entry["AUI"]
+
+            if sab in SAB:
+                if tty in term_types:
+                    aui_subset[aui] = entry
+                    j += 1
+            i += 1
+    finally:
+        mrconso.close()
 
     print("Extracted %s AUIs from a total of %s" % (j, i))
 
     mrrel_rrf  = "MRREL.RRF"
     mrrel_file_layout = file_layout[mrrel_rrf]
     mrrel_rrf_file_name = os.path.join(umls_directory, mrrel_rrf)
-    mrrel = RRFReader(mrrel_rrf_file_name, mrrel_file_layout)
+    mrrel = open_rrf_reader(mrrel_rrf_file_name, mrrel_file_layout, pipeline_queue_depth)
 
     k = 0
     l = 0
-    for relationship in mrrel:
-        sab = relationship["SAB"]
-        aui = relationship["AUI1"]
-
-        if sab in SAB:
-            if aui in aui_subset:
-                if "relationships" in aui_subset[aui]:
-                    aui_subset[aui]["relationships"] += [relationship]
-                else:
-                    aui_subset[aui]["relationships"] = [relationship]
-                l += 1
-        k += 1
+    try:
+        for relationship in mrrel:
+            sab = relationship["SAB"]
+            aui = relationship["AUI1"]
+
+            if sab in SAB:
+                if aui in aui_subset:
+                    if "relationships" in aui_subset[aui]:
+                        aui_subset[aui]["relationships"] += [relationship]
+                    else:
+                        aui_subset[aui]["relationships"] = [relationship]
+                    l += 1
+            k += 1
+    finally:
+        mrrel.close()
 
     print("Extracted %s relationships from a total of %s" % (l, k))
 
     mrsat_rrf = "MRSAT.RRF"
     mrsat_file_layout = file_layout[mrsat_rrf]
     mrsat_rrf_file_name = os.path.join(umls_directory, mrsat_rrf)
-    mrsat = RRFReader(mrsat_rrf_file_name, mrsat_file_layout)
+    mrsat = open_rrf_reader(mrsat_rrf_file_name, mrsat_file_layout, pipeline_queue_depth)
 
     m = 0
     n = 0
-    for attribute in mrsat:
-        sab = attribute["SAB"]
-        aui = attribute["METAUI"]
-
-        if sab in SAB:
-            if aui in aui_subset:
-                if "attributes" in aui_subset[aui]:
-                    aui_subset[aui]["attributes"] += [attribute]
-                else:
-                    aui_subset[aui]["attributes"] = [attribute]
-                    n += 1
-        m += 1
+    try:
+        for attribute in mrsat:
+            sab = attribute["SAB"]
+            aui = attribute["METAUI"]
+
+            if sab in SAB:
+                if aui in aui_subset:
+                    if "attributes" in aui_subset[aui]:
+                        aui_subset[aui]["attributes"] += [attribute]
+                    else:
+                        aui_subset[aui]["attributes"] = [attribute]
+                        n += 1
+            m += 1
+    finally:
+        mrsat.close()
 
     print("Extracted %s attributes from a total of %s" % (n, m))
 
     mrdef_rrf = "MRDEF.RRF"
     mrdef_file_layout = file_layout[mrdef_rrf]
     mrdef_rrf_file_name = os.path.join(umls_directory, mrdef_rrf)
-    mrdef = RRFReader(mrdef_rrf_file_name, mrdef_file_layout)
+    mrdef = open_rrf_reader(mrdef_rrf_file_name, mrdef_file_layout, pipeline_queue_depth)
 
     o = 0
     r = 0
     s = 0
 
-    for definition in mrdef:
-        sab = definition["SAB"]
-        if sab in SAB:
-            aui = definition["AUI"]
-            definition = definition["DEF"]
-            if aui in aui_subset:
-                aui_subset[aui]["definition"] = definition
-            else:
-                s += 1
-            r += 1
-        o += 1
+    try:
+        for definition in mrdef:
+            sab = definition["SAB"]
+            if sab in SAB:
+                aui = definition["AUI"]
+                definition = definition["DEF"]
+                if aui in aui_subset:
+                    aui_subset[aui]["definition"] = definition
+                else:
+                    s += 1
+                r += 1
+            o += 1
+    finally:
+        mrdef.close()
 
     print("Extracted %s definitions from a total of %s" % (r, o))
     print("Some AUIs could not be mapped %s" % s)
@@ -591,8 +1768,18 @@ def publish_CPT_MTHCH(umls_directory, refresh_json_file):
     return publish_source_vocabulary(umls_directory, sab=["CPT", "MTHCH"], tty_list=["PT", "HT"], refresh_json_file=refresh_json_file)
 
 
-def connect_vocabularies(mapping_file_name, umls_skos_obj_from, umls_skos_obj_to):
+def connect_vocabularies(mapping_file_name, umls_skos_obj_from, umls_skos_obj_to, pipeline_queue_depth=None,
+                         triple_store=None, refresh_mapping_file=False, triple_fingerprints=None):
+    """Connects two vocabularies through a mapping file which is generated from the vocabularies when it does not
+    exist or refresh_mapping_file is set. With mapping_file_name None the mapping rows are generated in memory."""
+    if mapping_file_name is not None:
+        if refresh_mapping_file or not os.path.exists(mapping_file_name):
+            write_mapping_file(mapping_file_name, umls_skos_obj_from, umls_skos_obj_to)
+
     cross_vocab_obj = UMLS2SKOSCrossVocabulary(mapping_file_name, umls_skos_obj_from, umls_skos_obj_to)
+    cross_vocab_obj.set_pipelined_output(pipeline_queue_depth)
+    cross_vocab_obj.set_triple_store(triple_store)
+    cross_vocab_obj.set_triple_deduplication(triple_fingerprints)
     cross_vocab_obj.write_out_annotation_files()
     cross_vocab_obj.write_out_isf_mapping_file()
 
@@ -614,14 +1801,13 @@ def main():
     icd9cm_isf = publish_icd9cm(umls_directory, refresh_json_file)
     if len(sys.argv) <= 2:
         nci_isf = publish_nci(umls_directory, refresh_json_file)
-        connect_vocabularies("../mappings/icd_to_nci_fast_trans.csv", icd9cm_isf, nci_isf)
+        connect_vocabularies(None, icd9cm_isf, nci_isf)
 
     else:
         msh_isf = publish_MeSH(umls_directory, refresh_json_file)
         connect_vocabularies("../mappings/ICD_to_MSH_fast_trans_with_header.csv", icd9cm_isf, msh_isf)
         cpt_isf = publish_CPT_MTHCH(umls_directory, refresh_json_file)
-        #TODO: Complete mapping file this is just a stub
-        connect_vocabularies("../mappings/cpt_to_msh_fast_trans.csv", cpt_isf, msh_isf)
+        connect_vocabularies(None, cpt_isf, msh_isf)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file